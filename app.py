@@ -2,13 +2,116 @@
 # - Auto-runs as soon as an image is uploaded
 # - No mock mode, no OCR, no HEIC-specific handling
 
+import io
 import os
 import json
-import tempfile
+import hashlib
 from datetime import datetime
+from pathlib import Path
 
 import streamlit as st
-from math_image_grader import run_grader, grade_with_equation_and_task
+from PIL import Image, ImageOps
+from math_image_grader import run_grader_bytes, grade_with_equation_and_task
+
+try:
+    import orjson
+
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+except ImportError:
+    def _dumps(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False, indent=2)
+
+# Budgets for the cached static preview: downscaled and re-encoded once per
+# upload, then served straight from disk. The vision payload itself is
+# prepared inside the grader (EXIF-upright + downscale + JPEG, memoized), so
+# nothing is pre-encoded here.
+VISION_MAX_EDGE = 1600
+VISION_JPEG_QUALITY = 85
+
+
+# Streamlit serves ./static at the app/static URL when static serving is on.
+_STATIC_UPLOADS = Path("static") / "uploads"
+
+
+def _static_preview_url(img_bytes: bytes) -> str | None:
+    """Write the downscaled preview under the static dir (content-hashed name)
+    and return its URL, or None when static serving is disabled.
+
+    st.image re-encodes and re-ships the image on every rerun; a static,
+    content-addressed file lets the browser cache it instead."""
+    try:
+        if not st.config.get_option("server.enableStaticServing"):
+            return None
+    except Exception:
+        return None
+    digest = hashlib.blake2b(img_bytes, digest_size=16).hexdigest()
+    dest = _STATIC_UPLOADS / f"{digest}.jpg"
+    if not dest.exists():
+        _STATIC_UPLOADS.mkdir(parents=True, exist_ok=True)
+        img = Image.open(io.BytesIO(img_bytes))
+        # re-encoding drops the EXIF tag the browser would have honored, so
+        # upright the pixels first or portrait photos display sideways
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((VISION_MAX_EDGE, VISION_MAX_EDGE), Image.LANCZOS)
+        img.convert("RGB").save(dest, "JPEG", quality=VISION_JPEG_QUALITY, optimize=True)
+    return f"app/static/uploads/{digest}.jpg"
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _cached_run_grader(img_bytes: bytes, grade: str):
+    """Memoized wrapper around run_grader keyed on the raw image bytes.
+
+    Streamlit reruns the whole script on every widget interaction; without
+    this cache the expensive vision calls were repeated on identical bytes
+    (e.g. toggling the debug checkbox). Cache hits return instantly.
+
+    The raw upload bytes go straight to the grader, whose memoized encoder
+    does the single EXIF-upright + downscale + JPEG pass; pre-encoding here
+    would add a second lossy generation and double the CPU work."""
+    return run_grader_bytes(img_bytes, grade, out_json_path=None)
+
+
+def _render_extracted(eq_ltx: str, eq_ascii: str, student_attempt: str, task_text: str):
+    """Render the extracted fields in a single pass: one st.write for the
+    task, one st.latex, one st.code for the ascii form, one for the attempt."""
+    st.markdown("**Extracted problem text:**")
+    st.write(task_text or "(none)")
+
+    st.markdown("**Extracted equation:**")
+    if eq_ltx:
+        try:
+            st.latex(eq_ltx)  # pretty, typeset math
+        except Exception:
+            pass
+    if eq_ascii:
+        # show ascii either as fallback or alongside LaTeX
+        st.code(eq_ascii)
+
+    st.markdown("**Student attempt:**")
+    st.code(student_attempt or "(none)")
+
+
+def _parse_combined(combined):
+    """Walk the combined result dict once and return the fields the UI needs:
+    (task_text, eq_latex, eq_ascii, student_attempt, extracted)."""
+    extracted = combined.get("extracted", {}) or {}
+    eq = extracted.get("equation") or {}
+    task = extracted.get("task") or {}
+    return (
+        task.get("question_text") or "",
+        (eq.get("latex") or "").strip(),
+        (eq.get("ascii") or "").strip(),
+        extracted.get("student_attempt") or "",
+        extracted,
+    )
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _cached_manual_grade(equation: str, grade: str, student_text: str):
+    """Memoized manual-mode grading keyed on (equation, grade, attempt)."""
+    task_obj = {"task_type": "other", "parameters": {}, "question_text": "Grade this solution."}
+    return grade_with_equation_and_task(equation, grade, task_obj, student_text)
 
 st.set_page_config(
     page_title="Math Teaching Assistant (Vision + 0–4 grading)",
@@ -34,13 +137,7 @@ with st.expander("Manual mode (paste equation & student attempt)"):
     man_student  = st.text_area("Student attempt (text)", value="", height=120, key="_manual_stu")
     if st.button("Grade manual input"):
         try:
-            task_obj = {"task_type": "other", "parameters": {}, "question_text": "Grade this solution."}
-            graded = grade_with_equation_and_task(
-                man_equation.strip(),
-                grade_input,
-                task_obj,
-                man_student.strip()
-            )
+            graded = _cached_manual_grade(man_equation.strip(), grade_input, man_student.strip())
             st.success("Graded (manual mode). See results below.")
             st.session_state["_manual_solution"] = graded
         except Exception as e:
@@ -58,81 +155,55 @@ solution = None
 
 if uploaded_file is not None:
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f"_{uploaded_file.name}") as tmp:
-            tmp.write(uploaded_file.getbuffer())
-            tmp_path = tmp.name
-
+        img_bytes = uploaded_file.getvalue()
         with st.spinner("Reading the image and grading..."):
-            combined, human_summary = run_grader(tmp_path, grade_input, out_json_path=None)
+            combined, human_summary = _cached_run_grader(img_bytes, grade_input)
 
         st.success("Done.")
         st.caption(human_summary or "")
 
         # ---- Show what we extracted (text + nicely rendered formula) ----
-        extracted = combined.get("extracted", {}) or {}
-        eq = (extracted.get("equation") or {})
-        task = (extracted.get("task") or {})
-        student_attempt = extracted.get("student_attempt") or ""
+        # Parse the combined dict once per upload; reruns on the same image
+        # reuse the tuple from session state instead of re-walking the dicts.
+        combined_key = hashlib.blake2b(img_bytes, digest_size=16).hexdigest()
+        if st.session_state.get("_parsed_key") == combined_key:
+            task_text, eq_ltx, eq_ascii, student_attempt, extracted = st.session_state["_parsed"]
+        else:
+            task_text, eq_ltx, eq_ascii, student_attempt, extracted = _parse_combined(combined)
+            st.session_state["_parsed"] = (task_text, eq_ltx, eq_ascii, student_attempt, extracted)
+            st.session_state["_parsed_key"] = combined_key
 
+        # --- Side-by-side input image + extracted text/formula ---
+        # Each st.* call is a websocket round-trip and a frontend re-layout,
+        # so every extracted field is rendered exactly once.
         st.markdown("### What we detected from the image")
-        # Problem text
-        st.markdown("**Problem text (task):**")
-        st.write(task.get("question_text") or "(none)")
-        # Equation (rendered first, fallback to ASCII, then raw LaTeX)
-        st.markdown("**Equation:**")
-        eq_ltx = (eq.get("latex") or "").strip()
-        eq_ascii = (eq.get("ascii") or "").strip()
-        if eq_ltx:
-            try:
-                st.latex(eq_ltx)  # pretty, typeset math
-            except Exception:
-                pass
-        if eq_ascii:
-            st.code(eq_ascii)
-
-        # --- NEW: side-by-side input image + extracted text/formula ---
-        st.markdown("### Preview")
         col_img, col_text = st.columns(2, gap="large")
 
         with col_img:
             st.markdown("**Input image**")
-            st.image(tmp_path, use_column_width=True)
+            preview_url = _static_preview_url(img_bytes)
+            if preview_url:
+                st.markdown(f'<img src="{preview_url}" style="max-width:100%"/>', unsafe_allow_html=True)
+            else:
+                st.image(uploaded_file, use_column_width=True)
 
         with col_text:
-            st.markdown("**Extracted problem text:**")
-            st.write(task.get("question_text") or "(none)")
-
-            st.markdown("**Extracted equation:**")
-            if eq_ltx:
-                try:
-                    st.latex(eq_ltx)   # nicely rendered math
-                except Exception:
-                    pass
-            if eq_ascii:
-                # show ascii either as fallback or alongside LaTeX
-                st.code(eq_ascii)
-
-            st.markdown("**Student attempt:**")
-            st.code(student_attempt or "(none)")
+            _render_extracted(eq_ltx, eq_ascii, student_attempt, task_text)
 
         if eq_ltx:
             with st.expander("Show raw LaTeX (debug)"):
                 st.code(eq_ltx)
 
-        # Student attempt
-        st.markdown("**Student attempt (as text):**")
-        st.code(student_attempt or "(none)")
-
         # Show extraction JSON for full transparency
         with st.expander("Extraction JSON (full)"):
-            st.code(json.dumps(extracted, ensure_ascii=False, indent=2))
+            st.code(_dumps(extracted))
 
         solution = combined.get("solution")
 
         # Offer download of full JSON
         st.download_button(
             label="⬇️ Download result JSON",
-            data=json.dumps(combined, ensure_ascii=False, indent=2),
+            data=_dumps(combined).encode("utf-8"),
             file_name=f"grader_output_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
             mime="application/json",
             use_container_width=True
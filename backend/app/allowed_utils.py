@@ -1,33 +1,59 @@
 # backend/app/allowed_utils.py
 import json
 import os
+from functools import lru_cache
 from typing import Iterable
 
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
 DEFAULT_JSON = os.path.join(os.path.dirname(__file__), "allowed_emails.json")
 
+# Single C-level byte translation for the common all-ASCII case; str.lower()
+# is Unicode-aware and noticeably slower on plain ASCII addresses.
+_ASCII_LOWER = bytes.maketrans(bytes(range(0x41, 0x5B)), bytes(range(0x61, 0x7B)))
+
 def normalize_email(e: str) -> str:
     if not e:
         return ""
-    return e.strip().lower()
+    e = e.strip()
+    try:
+        return e.encode("ascii").translate(_ASCII_LOWER).decode("ascii")
+    except UnicodeEncodeError:
+        # rare non-ASCII address: keep the correct Unicode lowering
+        return e.lower()
 
-def load_emails_from_json(path: str | None = None) -> list[str]:
-    path = path or DEFAULT_JSON
+@lru_cache(maxsize=8)
+def _load_emails_cached(path: str, mtime: float) -> frozenset[str]:
+    # mtime participates in the cache key so edits to the file invalidate
+    # the cached set without restarting the process.
     try:
-        with open(path, "r", encoding="utf-8") as fh:
-            data = json.load(fh)
+        with open(path, "rb") as fh:
+            data = _loads(fh.read())
         if isinstance(data, dict):
             emails = data.get("allowed_emails", [])
         elif isinstance(data, list):
             emails = data
         else:
-            return []
-        return [normalize_email(x) for x in emails if isinstance(x, str) and x.strip()]
-    except FileNotFoundError:
-        return []
+            return frozenset()
+        return frozenset(normalize_email(x) for x in emails if isinstance(x, str) and x.strip())
     except Exception:
-        # any parsing error -> behave as empty list
-        return []
+        # any parsing error -> behave as empty set
+        return frozenset()
+
+def load_emails_from_json(path: str | None = None) -> frozenset[str]:
+    path = path or DEFAULT_JSON
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return frozenset()
+    return _load_emails_cached(path, mtime)
 
 def email_in_list(email: str, allowed_iter: Iterable[str]) -> bool:
     en = normalize_email(email)
-    return any(en == normalize_email(a) for a in allowed_iter)
+    if isinstance(allowed_iter, (set, frozenset)):
+        return en in allowed_iter
+    return en in {normalize_email(a) for a in allowed_iter}
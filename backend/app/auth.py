@@ -8,8 +8,11 @@ Provides:
  - create_access_token(data, expires_delta=None) -> str
  - authenticate_user(db, username_or_email, password) -> user model or None
 
-This uses a SHA-256 hex pre-hash to avoid bcrypt 72-byte limit, then uses passlib CryptContext
-(bcrypt_sha256 preferred) to store and verify hashes.
+New passwords go straight to passlib's bcrypt_sha256, which pre-hashes with
+SHA-256 internally and so already sidesteps bcrypt's 72-byte limit. Hashes
+written before that change stored bcrypt_sha256 of a hex SHA-256 digest of
+the password; verification falls back to that legacy form and
+authenticate_user transparently rewrites such hashes on successful login.
 """
 
 import os
@@ -33,35 +36,39 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 60 * 24))
 
 
-def _sha256_hex(s: str) -> str:
-    """Return SHA-256 hex digest of the given string (deterministic, 64 hex chars)."""
-    if isinstance(s, bytes):
-        b = s
-    else:
-        b = s.encode("utf-8", errors="surrogatepass")
-    return hashlib.sha256(b).hexdigest()
-
-
 def get_password_hash(password: str) -> str:
     """
     Hash a password for storage.
-    We first compute the SHA-256 hex digest then call passlib to hash that digest.
+    bcrypt_sha256 pre-hashes internally, so the plaintext goes straight in.
     """
-    digest = _sha256_hex(password)
-    return pwd_context.hash(digest)
+    return pwd_context.hash(password)
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
+def _verify_with_legacy(plain_password: str, hashed_password: str) -> tuple[bool, bool]:
     """
-    Verify a plaintext password against a stored hash.
-    Compute SHA-256 digest of the plain password and verify against stored.
+    Verify against the current form, then the legacy sha256-digest form.
+    Returns (ok, needs_rehash) — needs_rehash is True when only the legacy
+    form matched and the stored hash should be rewritten.
     """
-    digest = _sha256_hex(plain_password)
     try:
-        return pwd_context.verify(digest, hashed_password)
+        if pwd_context.verify(plain_password, hashed_password):
+            return True, False
+    except Exception:
+        pass
+    try:
+        legacy_digest = hashlib.sha256(plain_password.encode("utf-8")).hexdigest()
+        if pwd_context.verify(legacy_digest, hashed_password):
+            return True, True
     except Exception:
-        # Any exception -> treat as verification failure
-        return False
+        pass
+    return False, False
+
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    """
+    Verify a plaintext password against a stored hash (either form).
+    """
+    return _verify_with_legacy(plain_password, hashed_password)[0]
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
@@ -87,10 +94,20 @@ def authenticate_user(db: Session, username_or_email: str, password: str):
     user = (
         db.query(models.User)
         .filter((models.User.username == username_or_email) | (models.User.email == username_or_email))
+        .limit(1)
         .first()
     )
     if not user:
         return None
-    if not verify_password(password, user.hashed_password):
+    ok, needs_rehash = _verify_with_legacy(password, user.hashed_password)
+    if not ok:
         return None
+    if needs_rehash:
+        # opportunistic migration off the legacy digest form; never fail a
+        # successful login over it
+        try:
+            user.hashed_password = get_password_hash(password)
+            db.commit()
+        except Exception:
+            db.rollback()
     return user
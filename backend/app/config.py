@@ -0,0 +1,28 @@
+# backend/app/config.py
+"""
+Frozen settings snapshot for the password-reset / SMTP path.
+
+Environment variables are read once at import time instead of per request;
+main.py previously called os.getenv repeatedly across
+create_password_reset_token / request_password_reset / send_reset_email.
+"""
+
+import os
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+    RESET_TOKEN_EXP_MINUTES: int = int(os.getenv("RESET_TOKEN_EXP_MINUTES", "60"))
+    RESET_JWT_SECRET: str = os.getenv("RESET_JWT_SECRET", os.getenv("SECRET_KEY", "CHANGE_ME_TO_A_SECURE_RANDOM_KEY"))
+    RESET_JWT_ALGO: str = "HS256"
+    FRONTEND_ORIGIN: str = os.getenv("FRONTEND_ORIGIN", "http://localhost:5173")
+    SMTP_HOST: str | None = os.getenv("SMTP_HOST")
+    SMTP_PORT: int = int(os.getenv("SMTP_PORT", "587"))
+    SMTP_USER: str | None = os.getenv("SMTP_USER")
+    SMTP_PASS: str | None = os.getenv("SMTP_PASS")
+    SMTP_FROM: str | None = os.getenv("SMTP_FROM", os.getenv("SMTP_USER"))
+    SMTP_CONFIGURED: bool = bool(os.getenv("SMTP_HOST"))
+
+
+settings = Settings()
@@ -5,5 +5,9 @@ from sqlalchemy.orm import sessionmaker, declarative_base
 DATABASE_URL = "sqlite:///./app.db"
 
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# expire_on_commit=False: committed objects keep their loaded attributes, so
+# serializing an ORM object after commit (e.g. /register's UserOut response)
+# doesn't silently re-SELECT the row. Sessions are request-scoped and
+# short-lived, so stale-attribute risk doesn't apply.
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 Base = declarative_base()
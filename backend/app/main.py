@@ -1,11 +1,15 @@
 # backend/app/main.py
 import os
+import shutil
 import traceback
 import tempfile
 from pathlib import Path
 
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form
+import anyio.to_thread
+from cachetools import TTLCache
+from fastapi import FastAPI, BackgroundTasks, Depends, HTTPException, UploadFile, File, Form
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from sqlalchemy import func, or_
 from sqlalchemy.orm import Session
 from . import database, models, schemas, auth, ocr_service, utils
 from .database import SessionLocal, engine
@@ -13,19 +17,37 @@ from fastapi.middleware.cors import CORSMiddleware
 
 import os
 import smtplib
+import threading
 from email.message import EmailMessage
 from jose import jwt, JWTError
 from datetime import timedelta
 from .allowed_utils import load_emails_from_json, normalize_email, email_in_list
+from .config import settings
 
 
-models.Base.metadata.create_all(bind=engine)
+# Auto-create tables on boot for dev; in multi-worker deployments set
+# AUTO_CREATE_TABLES=0 and run Alembic migrations instead, so workers don't
+# race on parallel DDL at startup.
+if os.getenv("AUTO_CREATE_TABLES", "1") == "1":
+    models.Base.metadata.create_all(bind=engine)
 
-app = FastAPI(title="Math Vision Grader")
+# orjson serializes several times faster than stdlib json; fall back to the
+# default JSONResponse when it isn't installed.
+try:
+    import orjson  # noqa: F401
+    from fastapi.responses import ORJSONResponse as _DefaultResponse
+except ImportError:
+    from fastapi.responses import JSONResponse as _DefaultResponse
+
+app = FastAPI(title="Math Vision Grader", default_response_class=_DefaultResponse)
+
+# Comma-separated list of allowed origins; "*" remains the dev default but
+# pinning real hosts lets browsers cache credentialed preflights.
+_cors_origins = os.getenv("CORS_ORIGINS", os.getenv("FRONTEND_ORIGIN", "*")).split(",")
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # change to your frontend host in production
+    allow_origins=_cors_origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
@@ -33,6 +55,14 @@ app.add_middleware(
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Per-request temp files never need to outlive the request, so keep them in
+# RAM-backed tmpfs when available instead of the disk-backed default.
+TMP_DIR = (
+    "/dev/shm"
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK)
+    else tempfile.gettempdir()
+)
+
 
 def get_db():
     db = SessionLocal()
@@ -54,30 +84,25 @@ def register_user(
     # normalize incoming email
     email_norm = normalize_email(email)
 
-    # load from DB (normalize). Be robust to different return shapes.
-    allowed_from_db = []
+    # single EXISTS-style probe instead of fetching the whole allowlist.
+    # lower(trim(...)) matches the baseline normalization of stored rows, so
+    # any-cased/padded DB entries still authorize. It can't use the plain
+    # index, but the allowlist is tiny (tens of rows) and rows are seeded
+    # outside this codebase, so there's no insert path to normalize at.
     try:
-        rows = db.query(models.AllowedEmail.email).all()
-        # rows may be list of tuples like [(email,), ...] or list of scalars depending on ORM
-        for r in rows:
-            if isinstance(r, (list, tuple)):
-                val = r[0]
-            else:
-                val = r
-            if val is None:
-                continue
-            allowed_from_db.append(str(val).strip().lower())
+        db_allowed = (
+            db.query(models.AllowedEmail.id)
+            .filter(func.lower(func.trim(models.AllowedEmail.email)) == email_norm)
+            .limit(1)
+            .first()
+            is not None
+        )
     except Exception:
-        # on any DB read error, treat DB list as empty and rely on JSON
-        allowed_from_db = []
-
-    # load allowed emails from JSON (runtime); this function returns normalized emails
-    allowed_from_json = load_emails_from_json()  # already normalized
+        # on any DB read error, rely on the JSON allowlist
+        db_allowed = False
 
-    # combine and deduplicate
-    combined_allowed = list(dict.fromkeys(allowed_from_db + allowed_from_json))
-    # finally check membership
-    if email_norm not in combined_allowed:
+    # JSON allowlist is a small secondary check (normalized set, cached per mtime)
+    if not db_allowed and email_norm not in load_emails_from_json():
         raise HTTPException(status_code=400, detail="Email is not authorized to register.")
 
     # password policy
@@ -86,20 +111,28 @@ def register_user(
             status_code=400,
             detail="Password does not meet policy (>=10 chars, number, special char).",
         )
-    # uniqueness
-    if db.query(models.User).filter(models.User.username == username).first():
-        raise HTTPException(status_code=400, detail="Username already taken.")
-    if db.query(models.User).filter(models.User.email == email).first():
+    # uniqueness: one indexed query instead of two round-trips
+    existing = (
+        db.query(models.User.username, models.User.email)
+        .filter(or_(models.User.username == username, models.User.email == email))
+        .limit(1)
+        .first()
+    )
+    if existing:
+        if existing.username == username:
+            raise HTTPException(status_code=400, detail="Username already taken.")
         raise HTTPException(status_code=400, detail="Email already registered.")
     user = models.User(
         username=username,
         email=email,
         hashed_password=auth.get_password_hash(password),
         grade_level=grade_level,
+        # set explicitly so UserOut doesn't need a post-commit refresh to
+        # pick up the column default
+        is_active=True,
     )
     db.add(user)
     db.commit()
-    db.refresh(user)
     return user
 
 
@@ -113,50 +146,64 @@ def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db:
 
 
 # ---------- Password reset helpers ----------
-RESET_TOKEN_EXP_MINUTES = int(os.getenv("RESET_TOKEN_EXP_MINUTES", "60"))  # 60 minutes default
-RESET_JWT_SECRET = os.getenv("RESET_JWT_SECRET", os.getenv("SECRET_KEY", "CHANGE_ME_TO_A_SECURE_RANDOM_KEY"))
-RESET_JWT_ALGO = "HS256"
-
-def create_password_reset_token(email: str, expires_minutes: int = RESET_TOKEN_EXP_MINUTES) -> str:
+def create_password_reset_token(email: str, expires_minutes: int = settings.RESET_TOKEN_EXP_MINUTES) -> str:
     payload = {"sub": email, "type": "pw_reset"}
     expire = datetime.utcnow() + timedelta(minutes=expires_minutes)
     payload.update({"exp": expire})
-    return jwt.encode(payload, RESET_JWT_SECRET, algorithm=RESET_JWT_ALGO)
+    return jwt.encode(payload, settings.RESET_JWT_SECRET, algorithm=settings.RESET_JWT_ALGO)
 
 def verify_password_reset_token(token: str) -> str:
     """
     Returns email if token is valid, otherwise raises JWTError.
     """
-    payload = jwt.decode(token, RESET_JWT_SECRET, algorithms=[RESET_JWT_ALGO])
+    payload = jwt.decode(token, settings.RESET_JWT_SECRET, algorithms=[settings.RESET_JWT_ALGO])
     if payload.get("type") != "pw_reset":
         raise JWTError("Invalid token type")
     return payload.get("sub")
 
+# Pooled SMTP connection: the TLS handshake + login dominate per-email
+# latency, so keep one lazily-opened connection and reconnect only on failure.
+_smtp_lock = threading.Lock()
+_smtp_conn: smtplib.SMTP | None = None
+
+def _open_smtp() -> smtplib.SMTP:
+    if not settings.SMTP_HOST:
+        raise RuntimeError("SMTP not configured")
+    smtp = smtplib.SMTP(settings.SMTP_HOST, settings.SMTP_PORT)
+    smtp.starttls()
+    if settings.SMTP_USER and settings.SMTP_PASS:
+        smtp.login(settings.SMTP_USER, settings.SMTP_PASS)
+    return smtp
+
 def send_reset_email(to_email: str, reset_link: str):
     """
     Send reset link via SMTP if SMTP env vars configured:
       SMTP_HOST, SMTP_PORT, SMTP_USER, SMTP_PASS, SMTP_FROM
     If not configured, this will raise or you can bypass for dev.
+    Reuses a module-level connection; reconnects once if the server
+    dropped it since the last send.
     """
-    SMTP_HOST = os.getenv("SMTP_HOST")
-    if not SMTP_HOST:
-        raise RuntimeError("SMTP not configured")
-    SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
-    SMTP_USER = os.getenv("SMTP_USER")
-    SMTP_PASS = os.getenv("SMTP_PASS")
-    FROM = os.getenv("SMTP_FROM", SMTP_USER)
+    global _smtp_conn
 
     msg = EmailMessage()
     msg["Subject"] = "Password reset for MathSight"
-    msg["From"] = FROM
+    msg["From"] = settings.SMTP_FROM
     msg["To"] = to_email
-    msg.set_content(f"Hello,\n\nUse the link below to reset your password (valid for {RESET_TOKEN_EXP_MINUTES} minutes):\n\n{reset_link}\n\nIf you didn't request this, ignore this message.\n")
-    # Send via TLS
-    with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as smtp:
-        smtp.starttls()
-        if SMTP_USER and SMTP_PASS:
-            smtp.login(SMTP_USER, SMTP_PASS)
-        smtp.send_message(msg)
+    msg.set_content(f"Hello,\n\nUse the link below to reset your password (valid for {settings.RESET_TOKEN_EXP_MINUTES} minutes):\n\n{reset_link}\n\nIf you didn't request this, ignore this message.\n")
+
+    with _smtp_lock:
+        if _smtp_conn is None:
+            _smtp_conn = _open_smtp()
+        try:
+            _smtp_conn.send_message(msg)
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPException, OSError):
+            # stale/broken connection -> reconnect and retry once
+            try:
+                _smtp_conn.close()
+            except Exception:
+                pass
+            _smtp_conn = _open_smtp()
+            _smtp_conn.send_message(msg)
 
 # ---------- API endpoints ----------
 from fastapi import Body
@@ -175,11 +222,9 @@ def request_password_reset(email: str = Body(..., embed=True), db: Session = Dep
 
     token = create_password_reset_token(email)
     # Build reset link -> frontend should have a reset route that accepts token
-    FRONTEND_ORIGIN = os.getenv("FRONTEND_ORIGIN", "http://localhost:5173")
-    reset_link = f"{FRONTEND_ORIGIN}/reset-password?token={token}"
-    smtp_configured = bool(os.getenv("SMTP_HOST"))
+    reset_link = f"{settings.FRONTEND_ORIGIN}/reset-password?token={token}"
 
-    if smtp_configured:
+    if settings.SMTP_CONFIGURED:
         try:
             send_reset_email(email, reset_link)
             return {"ok": True, "message": "If the email is registered, a reset link has been sent."}
@@ -215,9 +260,22 @@ def reset_password(token: str = Body(...), new_password: str = Body(...), db: Se
 
 
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    from jose import jwt, JWTError
+# Short-lived token -> User cache so chatty frontends don't pay a DB
+# round-trip per authenticated request. The JWT signature is still verified
+# on every call; only the user lookup is skipped, and the 30s TTL means the
+# cache can never outlive token validity.
+#
+# get_current_user is a sync dependency, so FastAPI runs it on threadpool
+# threads concurrently, and TTLCache is not thread-safe — guard every access
+# with the lock. Cached entries are detached ORM instances shared across
+# sessions: safe while endpoints only read already-loaded attributes, but a
+# future endpoint that mutates current_user must re-fetch it from its own
+# session instead.
+_user_cache = TTLCache(maxsize=4096, ttl=30)
+_user_cache_lock = threading.Lock()
 
+
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     try:
         payload = jwt.decode(token, auth.SECRET_KEY, algorithms=[auth.ALGORITHM])
         username: str = payload.get("sub")
@@ -225,7 +283,13 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
             raise HTTPException(status_code=401, detail="Invalid token")
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
-    user = db.query(models.User).filter(models.User.username == username).first()
+    with _user_cache_lock:
+        user = _user_cache.get(token)
+    if user is None:
+        user = db.query(models.User).filter(models.User.username == username).first()
+        if user is not None:
+            with _user_cache_lock:
+                _user_cache[token] = user
     if user is None:
         raise HTTPException(status_code=401, detail="User not found")
     return user
@@ -236,8 +300,20 @@ def read_users_me(current_user: models.User = Depends(get_current_user)):
     return current_user
 
 
+def _remove_quiet(path):
+    try:
+        if path:
+            os.remove(path)
+    except Exception:
+        pass
+
+
 @app.post("/analyze-image", response_model=schemas.OCRResult)
-async def analyze_image(file: UploadFile = File(...), current_user: models.User = Depends(get_current_user)):
+async def analyze_image(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    current_user: models.User = Depends(get_current_user),
+):
     """
     Endpoint:
     - Accepts uploaded image (multipart/form-data)
@@ -245,52 +321,40 @@ async def analyze_image(file: UploadFile = File(...), current_user: models.User
     - Calls ocr_service.call_vision_once (single vision model call)
     - Calls ocr_service.call_single_analysis_llm (single analysis call)
     - Returns extracted_text and analysis dict
+
+    The OCR/LLM calls are synchronous network I/O, so they run in the
+    threadpool to keep the event loop free for other requests.
     """
     tmp_input = None
-    temp_preprocessed = None
     try:
         # Save uploaded file temporarily with original extension
         suffix = Path(file.filename).suffix if file.filename else ".png"
-        tmp_input = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
-        contents = await file.read()
-        tmp_input.write(contents)
+        tmp_input = tempfile.NamedTemporaryFile(delete=False, suffix=suffix, dir=TMP_DIR)
+        # Stream to disk in 1MB chunks instead of buffering the whole body
+        shutil.copyfileobj(file.file, tmp_input, length=1024 * 1024)
         tmp_input.flush()
         tmp_input.close()
         image_path = tmp_input.name
 
-        # Vision call once -> extracted_text, may create an internal preprocessed temp file
-        extracted_text, temp_created = ocr_service.call_vision_once(image_path)
-        temp_preprocessed = temp_created
+        # Vision call once -> extracted_text (any preprocessing stays in memory).
+        # Run in the threadpool: blocking HTTP here would serialize all requests.
+        extracted_text = await anyio.to_thread.run_sync(
+            ocr_service.call_vision_once, image_path
+        )
 
-        # Single LLM analysis call
-        analysis = ocr_service.call_single_analysis_llm(extracted_text)
+        # Single LLM analysis call, also off the event loop
+        analysis = await anyio.to_thread.run_sync(
+            ocr_service.call_single_analysis_llm, extracted_text
+        )
 
-        # cleanup temp files
-        try:
-            if tmp_input:
-                os.remove(image_path)
-        except Exception:
-            pass
-        try:
-            if temp_preprocessed:
-                os.remove(temp_preprocessed)
-        except Exception:
-            pass
+        # cleanup the upload temp file after the response is sent
+        background_tasks.add_task(_remove_quiet, image_path)
 
         result = {"extracted_text": extracted_text, "analysis": analysis}
         return result
 
     except Exception as e:
         traceback.print_exc()
-        # try to remove temp files on error
-        try:
-            if tmp_input:
-                os.remove(tmp_input.name)
-        except Exception:
-            pass
-        try:
-            if temp_preprocessed:
-                os.remove(temp_preprocessed)
-        except Exception:
-            pass
+        # try to remove the temp file on error
+        _remove_quiet(tmp_input.name if tmp_input else None)
         raise HTTPException(status_code=500, detail=f"Processing failed: {e}")
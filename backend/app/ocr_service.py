@@ -5,10 +5,37 @@ from pathlib import Path
 from openai import OpenAI
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL_VISION = os.getenv("OPENAI_MODEL_VISION", "gpt-4o")  # adjust as necessary
-OPENAI_MODEL_TEXT = os.getenv("OPENAI_MODEL_TEXT", "gpt-4o")    # small text model for analysis; pick your account's available model
+OPENAI_MODEL_TEXT = os.getenv("OPENAI_MODEL_TEXT", "gpt-4o-mini")  # small text model for analysis; pick your account's available model
 
 openai_client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else OpenAI()
 
+_JSON_DECODER = json.JSONDecoder()
+
+def _extract_json_obj(s):
+    """
+    Parse the first JSON object embedded in s using raw_decode (single C-level
+    pass, handles braces inside strings correctly). Returns dict or None.
+    """
+    if not s:
+        return None
+    # JSON mode makes a bare object the common case
+    try:
+        obj = json.loads(s)
+        if isinstance(obj, dict):
+            return obj
+    except ValueError:
+        pass
+    idx = s.find("{")
+    while idx != -1:
+        try:
+            obj, _ = _JSON_DECODER.raw_decode(s, idx)
+            if isinstance(obj, dict):
+                return obj
+        except ValueError:
+            pass
+        idx = s.find("{", idx + 1)
+    return None
+
 def image_to_data_uri(path):
     with open(path, "rb") as f:
         data = f.read()
@@ -17,20 +44,24 @@ def image_to_data_uri(path):
     b64 = base64.b64encode(data).decode("utf-8")
     return f"data:{mime};base64,{b64}"
 
+def bytes_to_data_uri(data, mime="image/jpeg"):
+    b64 = base64.b64encode(data).decode("utf-8")
+    return f"data:{mime};base64,{b64}"
+
 def call_vision_once(image_path):
     """
-    1) Preprocess image if > 1MB (reduce_image_to_max_bytes)
+    1) Preprocess image if oversized (reduce_image_to_max_bytes, in memory)
     2) Send single vision-enabled call to extract text
-    Returns extracted_text (string) and optionally temp_path (to delete).
+    Returns extracted_text (string).
     """
-    temp = None
-    path_to_send = image_path
     try:
-        path_to_send = reduce_image_to_max_bytes(image_path, max_bytes=1_000_000)
-        if path_to_send != image_path:
-            temp = path_to_send
-
-        data_uri = image_to_data_uri(path_to_send)
+        reduced = reduce_image_to_max_bytes(image_path, max_bytes=1_000_000)
+        if reduced is not None:
+            # reducer always emits JPEG; base64 the bytes directly,
+            # no temp file and no read-back from disk
+            data_uri = bytes_to_data_uri(reduced)
+        else:
+            data_uri = image_to_data_uri(image_path)
 
         user_instruction = (
             "Extract the textual content from the image. The image contains:\n"
@@ -52,7 +83,8 @@ def call_vision_once(image_path):
             messages=[{"role":"system","content":"You are a precise extractor. Return results strictly as instructed."},
                       {"role":"user","content": content_blocks}],
             max_tokens=1400,
-            temperature=0.0
+            temperature=0.0,
+            response_format={"type": "json_object"}
         )
         assistant_text = None
         try:
@@ -60,30 +92,11 @@ def call_vision_once(image_path):
         except Exception:
             assistant_text = str(resp)
 
-        # parse JSON substring
-        idx = assistant_text.find("{")
-        if idx != -1:
-            # simple extraction of JSON block
-            # find closing brace
-            stack = []
-            start = None
-            for i,ch in enumerate(assistant_text):
-                if ch == "{":
-                    if start is None:
-                        start = i
-                    stack.append("{")
-                elif ch == "}":
-                    if stack:
-                        stack.pop()
-                        if not stack:
-                            json_text = assistant_text[start:i+1]
-                            try:
-                                parsed = json.loads(json_text)
-                                return parsed.get("extracted_text", ""), temp
-                            except:
-                                break
+        parsed = _extract_json_obj(assistant_text)
+        if parsed is not None:
+            return parsed.get("extracted_text", "")
         # fallback: return full assistant text as extracted_text
-        return assistant_text.strip(), temp
+        return assistant_text.strip()
 
     except Exception as e:
         raise RuntimeError("Vision call failed: " + str(e) + "\n" + traceback.format_exc())
@@ -120,29 +133,15 @@ def call_single_analysis_llm(extracted_text):
         model=OPENAI_MODEL_TEXT,
         messages=[{"role":"system","content":system_msg},{"role":"user","content":user_msg}],
         max_tokens=700,
-        temperature=0.0
+        temperature=0.0,
+        response_format={"type": "json_object"}
     )
     assistant_text = None
     try:
         assistant_text = resp.choices[0].message.content
     except Exception:
         assistant_text = str(resp)
-    # extract JSON substring
-    idx = assistant_text.find("{")
-    if idx == -1:
-        raise RuntimeError("Analysis model returned non-JSON response.")
-    stack = []
-    start = None
-    for i,ch in enumerate(assistant_text):
-        if ch == "{":
-            if start is None:
-                start = i
-            stack.append("{")
-        elif ch == "}":
-            if stack:
-                stack.pop()
-                if not stack:
-                    json_text = assistant_text[start:i+1]
-                    parsed = json.loads(json_text)
-                    return parsed
-    raise RuntimeError("Failed to parse JSON out of analysis model output.")
+    parsed = _extract_json_obj(assistant_text)
+    if parsed is None:
+        raise RuntimeError("Failed to parse JSON out of analysis model output.")
+    return parsed
@@ -1,61 +1,91 @@
 # backend/app/utils.py
-from PIL import Image
+from PIL import Image, ImageOps
 import os
-import tempfile
+import re
 from io import BytesIO
 
+# Pre-compiled policy patterns: C-level scans instead of per-char Python loops
+_DIGIT_RE = re.compile(r"\d")
+_SPECIAL_RE = re.compile(r"[\W_]")  # anything non-alphanumeric
+
 def is_password_valid(pw: str) -> bool:
+    # cheap length check first so typical rejections never touch the regexes
     if len(pw) < 10:
         return False
-    if not any(c.isdigit() for c in pw):
-        return False
-    if not any(not c.isalnum() for c in pw):
-        return False
-    return True
+    return bool(_DIGIT_RE.search(pw)) and bool(_SPECIAL_RE.search(pw))
+
+def _encode_jpeg(img: Image.Image, quality: int) -> bytes:
+    buf = BytesIO()
+    # 4:2:0 chroma subsampling is visually lossless on page/text content and
+    # shaves another 10-20% off the payload
+    img.save(buf, format="JPEG", quality=quality, optimize=True, progressive=True, subsampling=2)
+    return buf.getvalue()
 
-def reduce_image_to_max_bytes(input_path: str, max_bytes: int = 1_000_000) -> str:
+def reduce_image_to_max_bytes(input_path: str, max_bytes: int = 1_000_000, max_dim: int = 1536) -> bytes | None:
     """
-    If input file <= max_bytes returns original path.
-    Otherwise creates a compressed/resized JPEG temp file <= max_bytes (best-effort).
-    Returns path to file to use (temp or original).
+    If input file <= max_bytes AND fits within max_dim, returns None
+    (the original file can be sent as-is).
+    Otherwise returns compressed/resized JPEG bytes <= max_bytes (best-effort)
+    bounded to max_dim on the long edge. The result stays in memory — callers
+    base64 it directly, no temp-file round trip.
+    max_dim: pixel budget — vision models tile images, so anything past
+             ~1536px on the long edge costs extra tiles without helping
+             transcription of page-scale text.
     """
     size = os.path.getsize(input_path)
-    if size <= max_bytes:
-        return input_path
+    # reading .size only parses the header, not the pixel data
+    with Image.open(input_path) as probe:
+        orig_w, orig_h = probe.size
+    if size <= max_bytes and max(orig_w, orig_h) <= max_dim:
+        return None
 
-    img = Image.open(input_path).convert("RGB")
-    orig_w, orig_h = img.size
+    img = Image.open(input_path)
+    # bake EXIF orientation into the pixels before the re-save drops the tag,
+    # or portrait phone photos reach the vision model sideways
+    img = ImageOps.exif_transpose(img).convert("RGB")
+    # drop camera metadata/color profile so it isn't re-embedded on save
+    img.info.pop("exif", None)
+    img.info.pop("icc_profile", None)
 
-    # initial scale estimate
-    scale = (max_bytes / float(size)) ** 0.5
-    scale = max(0.2, min(0.98, scale))
-    new_w = max(200, int(orig_w * scale))
-    new_h = max(200, int(orig_h * scale))
-    img = img.resize((new_w, new_h), Image.LANCZOS)
+    # pixel budget first: this alone usually gets big photos under max_bytes
+    img.thumbnail((max_dim, max_dim), Image.LANCZOS)
 
-    quality = 90
-    buf = BytesIO()
-    img.save(buf, format="JPEG", quality=quality, optimize=True)
-    data = buf.getvalue()
-
-    # iteratively reduce quality
-    while len(data) > max_bytes and quality >= 30:
-        quality -= 10
-        buf = BytesIO()
-        img.save(buf, format="JPEG", quality=quality, optimize=True)
-        data = buf.getvalue()
-
-    # if still large, further downscale
-    while len(data) > max_bytes and (new_w > 300 and new_h > 300):
-        new_w = max(200, int(new_w * 0.9))
-        new_h = max(200, int(new_h * 0.9))
+    # then a byte-driven scale estimate if the file itself was oversized
+    if size > max_bytes:
+        scale = (max_bytes / float(size)) ** 0.5
+        scale = max(0.2, min(0.98, scale))
+        new_w = max(200, int(orig_w * scale))
+        new_h = max(200, int(orig_h * scale))
+        if new_w < img.size[0] or new_h < img.size[1]:
+            img = img.resize((min(new_w, img.size[0]), min(new_h, img.size[1])), Image.LANCZOS)
+    new_w, new_h = img.size
+
+    # JPEG size scales roughly linearly with quality in the 50-90 band, so
+    # one probe encode plus an analytic correction replaces the old
+    # step-down loop that could re-encode the full image up to 8 times.
+    data = _encode_jpeg(img, 85)
+    if len(data) > max_bytes:
+        quality = max(40, min(90, int(85 * max_bytes / len(data))))
+        data = _encode_jpeg(img, quality)
+        # if the linear estimate missed, binary-search the remaining band,
+        # keeping the best fitting encode so we never re-encode at the end
+        if len(data) > max_bytes and quality > 40:
+            lo, hi = 40, quality - 1
+            best = None
+            while hi - lo > 5:
+                mid = (lo + hi) // 2
+                candidate = _encode_jpeg(img, mid)
+                if len(candidate) > max_bytes:
+                    hi = mid - 1
+                else:
+                    best, lo = candidate, mid
+            data = best if best is not None else _encode_jpeg(img, lo)
+
+    # last resort: halve the pixel count once and retry at a fixed quality
+    if len(data) > max_bytes and (new_w > 300 and new_h > 300):
+        new_w = max(200, int(new_w * 0.707))
+        new_h = max(200, int(new_h * 0.707))
         img = img.resize((new_w, new_h), Image.LANCZOS)
-        buf = BytesIO()
-        img.save(buf, format="JPEG", quality=max(40, quality), optimize=True)
-        data = buf.getvalue()
-
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".jpg")
-    tmp.write(data)
-    tmp.flush()
-    tmp.close()
-    return tmp.name
+        data = _encode_jpeg(img, 75)
+
+    return data